@@ -5,19 +5,165 @@ See README.md in this directory for more information.
 """
 
 import argparse
-import gzip
-import multiprocessing
+try:
+    # ISA-L's SIMD-accelerated inflate is typically 3-4x faster than
+    # stdlib zlib; fall back to gzip when it isn't installed.  Its
+    # higher throughput also justifies a larger copy buffer.
+    from isal import igzip as gzip
+    gunzip_chunk = 4 * 1024 * 1024
+except ImportError:
+    import gzip
+    gunzip_chunk = 1024 * 1024
+import itertools
+import json
 import os
-import shutil
 import subprocess
 import sys
-import pandas as pd
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+# pandas (like matplotlib) is imported lazily where needed: its cold
+# import costs several hundred ms per invocation, which compounds when
+# the batch driver fans out worker processes.
 
 def try_remove(f):
+    Path(f).unlink(missing_ok=True)
+
+def list_dir(path):
+    """Return the set of entry names in path, empty if it doesn't exist."""
+    try:
+        return {e.name for e in os.scandir(path)}
+    except FileNotFoundError:
+        return set()
+
+def gunzip_wpop(src, dst):
+    """Decompress the gzipped population file src into dst."""
+    import shutil
+    with gzip.open(src, 'rb') as f_in:
+        with open(dst, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, gunzip_chunk)
+
+def gunzip_wpop_fd(src, fd):
+    """Decompress the gzipped population file src into file descriptor fd."""
+    import shutil
+    with gzip.open(src, 'rb') as f_in:
+        with open(fd, 'wb', closefd=False) as f_out:
+            shutil.copyfileobj(f_in, f_out, gunzip_chunk)
+
+def read_max_I(path):
+    """Return the maximum of the "I" column of the severity TSV at path.
+
+    Prefers pyarrow, which parses the table with multiple threads and
+    converts floats with SIMD; falls back to a single-threaded numpy
+    parse of just that column, and finally to pandas, the baseline
+    requirement of this script.
+    """
+    try:
+        import pyarrow.csv as pacsv
+        import pyarrow.compute as pc
+    except ImportError:
+        pacsv = None
+
+    if pacsv is not None:
+        tbl = pacsv.read_csv(
+                path,
+                parse_options=pacsv.ParseOptions(delimiter="\t"),
+                convert_options=pacsv.ConvertOptions(include_columns=["I"]))
+        return pc.max(tbl["I"]).as_py()
+
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    if np is not None:
+        with open(path) as f:
+            i_col = f.readline().rstrip("\n").split("\t").index("I")
+        return np.loadtxt(path, delimiter="\t", skiprows=1,
+                          usecols=(i_col,)).max()
+
+    import pandas as pd
+    return pd.read_csv(path, sep="\t", usecols=["I"],
+                       memory_map=True)["I"].max()
+
+def parse_max_I(lines):
+    """Return the maximum of the "I" column from severity TSV lines,
+    or None if no data rows were seen."""
+    it = iter(lines)
     try:
-        os.remove(f)
-    except OSError as e:
-        pass
+        i_col = next(it).rstrip("\n").split("\t").index("I")
+    except (StopIteration, ValueError):
+        return None
+    max_I = None
+    for line in it:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) > i_col:
+            try:
+                value = float(fields[i_col])
+            except ValueError:
+                continue
+            if max_I is None or value > max_I:
+                max_I = value
+    return max_I
+
+def stream_severity(fifo_path, file_path, result, proc):
+    """Drain the severity TSV from the pipe at fifo_path while proc runs.
+
+    CovidSim saves the summary results twice per run, and each save
+    opens the severity file afresh with "wb", so a single blocking read
+    of the pipe would hit EOF after the first save and leave the second
+    fopen waiting forever for a reader.  Instead the pipe is reopened
+    (non-blocking, so a CovidSim that exits early cannot wedge us)
+    until the process has exited, and each write session restarts the
+    capture just as "wb" truncation would.  The final session is saved
+    to file_path so a real severity file remains on disk for readonly
+    re-reads, and its maximum "I" value lands in result[0].
+    """
+    import select
+    import time
+    last = b""
+    while True:
+        fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        data = bytearray()
+        try:
+            while True:
+                if not select.select([fd], [], [], 0.2)[0]:
+                    # No writer has connected on this open yet; give up
+                    # once the process is gone
+                    if proc.poll() is not None:
+                        break
+                    continue
+                try:
+                    chunk = os.read(fd, 1 << 20)
+                except BlockingIOError:
+                    continue
+                if chunk:
+                    data += chunk
+                elif data or proc.poll() is not None:
+                    # Writer closed after a session, or CovidSim exited
+                    # without (re)opening the pipe
+                    break
+                else:
+                    # EOF before any writer connected: CovidSim hasn't
+                    # opened the pipe yet
+                    time.sleep(0.05)
+        finally:
+            os.close(fd)
+        if data:
+            last = bytes(data)
+        if proc.poll() is not None:
+            break
+    if last:
+        # If two write sessions ran back to back without an observed
+        # EOF between them they arrive concatenated; keep only the one
+        # starting at the last copy of the header line
+        header = last[:last.find(b"\n") + 1]
+        if header:
+            last = last[last.rfind(header):]
+        with open(file_path, "wb") as f:
+            f.write(last)
+        result[0] = parse_max_I(last.decode().splitlines())
 
 def parse_args():
     """Parse the arguments.
@@ -29,19 +175,19 @@ def parse_args():
     args.paramdir is the directory with the parameters in it
     args.outputdir is the directory where output will be stored
     args.threads is the number of threads to use
+    args.batch is an optional JSON file describing a parameter sweep
     """
     parser = argparse.ArgumentParser()
-    try:
+    if hasattr(os, "sched_getaffinity"):
         cpu_count = len(os.sched_getaffinity(0))
-    except AttributeError:
-        # os.sched_getaffinity isn't available
-        cpu_count = multiprocessing.cpu_count()
-    if cpu_count is None or cpu_count == 0:
-        cpu_count = 2
+    else:
+        # os.sched_getaffinity isn't available; os.cpu_count is a
+        # cached sysctl and may return None
+        cpu_count = os.cpu_count() or 2
 
     script_path = os.path.dirname(os.path.realpath(__file__))
     data_dir = os.path.join(script_path, "covid_sim")
-    
+
     # Default values
     param_dir = os.path.join(data_dir, "param_files")
     output_dir = os.path.join(data_dir, "output_files")
@@ -90,12 +236,31 @@ def parse_args():
             help="whether to simply read and plot final excel results",
             default=read_only
             )
+    parser.add_argument(
+            "--batch",
+            help="JSON file describing a parameter sweep to run",
+            default=None
+            )
+    parser.add_argument(
+            "--force",
+            help="run CovidSim even if the output is newer than all inputs",
+            action="store_true"
+            )
+    parser.add_argument(
+            "--dry-run",
+            help="print the CovidSim command line without running it",
+            action="store_true"
+            )
+    parser.add_argument(
+            "--stream-output",
+            help="reduce the severity output through a pipe while "
+                 "CovidSim runs (experimental, POSIX only)",
+            action="store_true"
+            )
     args = parser.parse_args()
 
     return args
 
-args = parse_args()
-
 # whether to plot final results
 plot = False
 
@@ -105,176 +270,443 @@ canada = [ "Canada" ]
 usa_territories = ["Alaska", "Hawaii", "Guam", "Virgin_Islands_US", "Puerto_Rico", "American_Samoa"]
 nigeria = ["Nigeria"]
 
-# Location of a user supplied executable (CovidSim.exe):
-exe = args.covidsim
-
-# Ensure output directory exists
-os.makedirs(args.outputdir, exist_ok=True)
-
-# The admin file to use
-admin_file = os.path.join(args.datadir, "admin_units",
-    "{0}_admin.txt".format(args.country))
-
-if not os.path.exists(admin_file):
-    print("Unable to find admin file for country: {0}".format(args.country))
-    print("Data directory: {0}".format(args.datadir))
-    print("Looked for: {0}".format(admin_file))
-    exit(1)
-
-# Population density file in gziped form, text file, and binary file as
-# processed by CovidSim
-if args.country in united_states + canada:
-    wpop_file_root = "usacan"
-elif args.country in usa_territories:
-    wpop_file_root = "us_terr"
-elif args.country in nigeria:
-    wpop_file_root = "nga_adm1"
-else:
-    wpop_file_root = "eur"
-
-wpop_file_gz = os.path.join(
-        args.datadir,
-        "populations",
-        "wpop_{0}.txt.gz".format(wpop_file_root))
-if not os.path.exists(wpop_file_gz):
-    print("Unable to find population file for country: {0}".format(args.country))
-    print("Data directory: {0}".format(args.datadir))
-    print("Looked for: {0}".format(wpop_file_gz))
-    exit(1)
-
-wpop_file = os.path.join(
-        args.networkdir,
-        "wpop_{0}.txt".format(wpop_file_root))
-wpop_bin = os.path.join(
-        args.networkdir,
-        "{0}_pop_density.bin".format(args.country))
-
-if args.firstsetup == 'Y':
-    try_remove(wpop_file)
-    try_remove(wpop_bin)
-
-# gunzip wpop fie
-with gzip.open(wpop_file_gz, 'rb') as f_in:
-    with open(wpop_file, 'wb') as f_out:
-        shutil.copyfileobj(f_in, f_out)
-
-# Configure pre-parameter file.  This file doesn't change between runs:
-if args.country in united_states:
-    pp_file = os.path.join(args.paramdir, "preUS_R0=2.0.txt")
-elif args.country in nigeria:
-    pp_file = os.path.join(args.paramdir, "preNGA_R0=2.0.txt")
-else:
-    pp_file = os.path.join(args.paramdir, "preUK_R0=2.0.txt")
-if not os.path.exists(pp_file):
-    print("Unable to find pre-parameter file")
-    print("Param directory: {0}".format(args.paramdir))
-    print("Looked for: {0}".format(pp_file))
-    exit(1)
-
-# Configure No intervention parameter file.  This is run first
-# and provides a baseline
-no_int_file = os.path.join(args.paramdir, "p_NoInt.txt")
-if not os.path.exists(no_int_file):
-    print("Unable to find parameter file")
-    print("Param directory: {0}".format(args.paramdir))
-    print("Looked for: {0}".format(no_int_file))
-    exit(1)
-
-# Configure an intervention (controls) parameter file.
-# In reality you will run CovidSim many times with different parameter
-# controls.
-root = "PC7_CI_HQ_SD"
-cf = os.path.join(args.paramdir, "p_{0}.txt".format(root))
-if not os.path.exists(cf):
-    print("Unable to find parameter file")
-    print("Param directory: {0}".format(args.paramdir))
-    print("Looked for: {0}".format(cf))
-    exit(1)
-
-school_file = None
-if args.country in united_states:
-    school_file = os.path.join(args.datadir, "populations", "USschools.txt")
-
-    if not os.path.exists(school_file):
-        print("Unable to find school file for country: {0}".format(args.country))
+# Country -> population grid root and pre-parameter file, precomputed
+# once so each run is a dict lookup rather than a chain of list checks
+country_wpop_root = {c: "usacan" for c in united_states + canada}
+country_wpop_root.update({c: "us_terr" for c in usa_territories})
+country_wpop_root.update({c: "nga_adm1" for c in nigeria})
+
+country_pp_file = {c: "preUS_R0=2.0.txt" for c in united_states}
+country_pp_file.update({c: "preNGA_R0=2.0.txt" for c in nigeria})
+
+# Default seeds and intervention parameter root for single runs
+default_seeds = ["98798150", "729101", "17389101", "4797132"]
+default_root = "PC7_CI_HQ_SD"
+
+def out_stem_name(country, root, r, firstsetup, clp1, clp2, clp3, seeds):
+    """File-name stem for everything CovidSim writes for one run.
+
+    Intervention runs encode the /CLPx: controls and any non-default
+    seeds, so sweep cells that differ only in those never share output
+    files.  First-setup runs don't take /CLPx: controls, so their stems
+    carry only the seeds.
+    """
+    stem = "{0}_{1}_R0={2}".format(country, root, r)
+    if firstsetup == 'N':
+        stem += "_CLP={0}-{1}-{2}".format(clp1, clp2, clp3)
+    if list(seeds) != default_seeds:
+        stem += "_S=" + "-".join(seeds)
+    return stem
+
+def run_one(args, country, root, clp1, clp2, clp3, seeds, use_fifo=True):
+    """Run CovidSim once for a single sweep cell.
+
+    country is the country to simulate, root names the intervention
+    parameter file (p_{root}.txt), clp1/clp2/clp3 are the /CLPx:
+    intervention controls, and seeds is the list of four RNG seeds.
+
+    On exit: Returns the maximum value of the "I" column from the
+    severity output.
+    """
+    # Location of a user supplied executable (CovidSim.exe):
+    exe = args.covidsim
+
+    # Ensure output directory exists
+    os.makedirs(args.outputdir, exist_ok=True)
+
+    # Cache the input directory listings so each input check below is a
+    # set lookup instead of a separate stat call
+    admin_dir = os.path.join(args.datadir, "admin_units")
+    pop_dir = os.path.join(args.datadir, "populations")
+    admin_set = list_dir(admin_dir)
+    pop_set = list_dir(pop_dir)
+    param_set = list_dir(args.paramdir)
+
+    # The admin file to use
+    admin_file = os.path.join(admin_dir,
+        "{0}_admin.txt".format(country))
+
+    if os.path.basename(admin_file) not in admin_set:
+        print("Unable to find admin file for country: {0}".format(country))
+        print("Data directory: {0}".format(args.datadir))
+        print("Looked for: {0}".format(admin_file))
+        exit(1)
+
+    # Population density file in gziped form, text file, and binary file as
+    # processed by CovidSim
+    wpop_file_root = country_wpop_root.get(country, "eur")
+
+    wpop_file_gz = os.path.join(
+            pop_dir,
+            "wpop_{0}.txt.gz".format(wpop_file_root))
+    if os.path.basename(wpop_file_gz) not in pop_set:
+        print("Unable to find population file for country: {0}".format(country))
         print("Data directory: {0}".format(args.datadir))
-        print("Looked for: {0}".format(school_file))
+        print("Looked for: {0}".format(wpop_file_gz))
+        exit(1)
+
+    wpop_file = os.path.join(
+            args.networkdir,
+            "wpop_{0}.txt".format(wpop_file_root))
+    wpop_bin = os.path.join(
+            args.networkdir,
+            "{0}_pop_density.bin".format(country))
+
+    # Configure pre-parameter file.  This file doesn't change between runs:
+    pp_file = os.path.join(args.paramdir,
+            country_pp_file.get(country, "preUK_R0=2.0.txt"))
+    if os.path.basename(pp_file) not in param_set:
+        print("Unable to find pre-parameter file")
+        print("Param directory: {0}".format(args.paramdir))
+        print("Looked for: {0}".format(pp_file))
+        exit(1)
+
+    # Configure No intervention parameter file.  This is run first
+    # and provides a baseline
+    no_int_file = os.path.join(args.paramdir, "p_NoInt.txt")
+    if os.path.basename(no_int_file) not in param_set:
+        print("Unable to find parameter file")
+        print("Param directory: {0}".format(args.paramdir))
+        print("Looked for: {0}".format(no_int_file))
         exit(1)
 
-# Some command_line settings
-r = 3.0
-rs = r/2
-
-# This is the temporary network that represents initial state of the
-# simulation
-network_bin = os.path.join(
-        args.networkdir,
-        "Network_{0}_T{1}_R{2}.bin".format(args.country, args.threads, r))
-
-if args.firstsetup == 'Y':
-    try_remove(network_bin)
-
-# Run the no intervention sim.  This also does some extra setup which is one
-# off for each R.
-
-cf = os.path.join(args.paramdir, "p_{0}.txt".format(root))
-print("Intervention: {0} {1} {2}".format(args.country, root, r))
-cmd = [
-        exe,
-        "/c:{0}".format(args.threads),
-        "/A:" + admin_file
-        ]
-if school_file:
-    cmd.extend(["/s:" + school_file])
-
-if args.firstsetup == 'Y':
-
-    cmd.extend([
-            "/PP:" + pp_file, # Preparam file
-            "/P:" + cf, # Param file
-            "/O:" + os.path.join(args.outputdir,
-                "{0}_{1}_R0={2}".format(args.country, root, r)), # Output
-            "/D:" + wpop_file, # Input (this time text) pop density
-            "/M:" + wpop_bin, # Where to save binary pop density
-            "/S:" + network_bin, # Where to save binary net setup
-            "/R:{0}".format(rs),
-            "/BM:PNG",
-            "98798150", # These four numbers are RNG seeds
-            "729101",
-            "17389101",
-            "4797132"
-            ])
-
-elif args.firstsetup == 'N':
-    
-    cmd.extend([
-            "/PP:" + pp_file,
-            "/P:" + cf,
-            "/O:" + os.path.join(args.outputdir,
-                "{0}_{1}_R0={2}".format(args.country, root, r)),
-            "/D:" + wpop_bin, # Binary pop density file (speedup)
-            "/L:" + network_bin, # Network to load
-            "/R:{0}".format(rs),
-            "/CLP1:1.0", # default is 1.0 (Individual level compliance with quarantine) [0.6 - 1.0] E
-            "/CLP2:0.1", # default is 0.1 (Relative spatial contact rate given social distancing) [0 - 0.4] S
-            "/CLP3:0.1", # default is 0.9 (Proportion of detected cases isolated) [0.0 - 1.0] T
-            "98798150",
-            "729101",
-            "17389101",
-            "4797132"
-            ])
-
-if args.readonly == 'N':    
-    print("Command line: " + " ".join(cmd))
-    process = subprocess.run(cmd, check=True)
-
-output_file = args.outputdir + "\{0}_{1}_R0={2}.avNE.severity.xls".format(args.country, root, r)
-data = pd.read_csv(output_file, sep="\t")
-df = pd.DataFrame(data)
-max_I = df["I"].max()
-print(max_I)
-
-if plot:
-    import matplotlib.pyplot as plt
-    plt.plot(df["I"])
-    plt.show()
\ No newline at end of file
+    # Configure an intervention (controls) parameter file.
+    # In reality you will run CovidSim many times with different parameter
+    # controls.
+    cf = os.path.join(args.paramdir, "p_{0}.txt".format(root))
+    if os.path.basename(cf) not in param_set:
+        print("Unable to find parameter file")
+        print("Param directory: {0}".format(args.paramdir))
+        print("Looked for: {0}".format(cf))
+        exit(1)
+
+    school_file = None
+    if country in united_states:
+        school_file = os.path.join(pop_dir, "USschools.txt")
+
+        if os.path.basename(school_file) not in pop_set:
+            print("Unable to find school file for country: {0}".format(country))
+            print("Data directory: {0}".format(args.datadir))
+            print("Looked for: {0}".format(school_file))
+            exit(1)
+
+    # Some command_line settings
+    r = 3.0
+    rs = r/2
+
+    # Common stem for everything CovidSim writes for this run
+    out_stem = os.path.join(args.outputdir, out_stem_name(
+            country, root, r, args.firstsetup, clp1, clp2, clp3, seeds))
+
+    # This is the temporary network that represents initial state of the
+    # simulation
+    network_bin = os.path.join(
+            args.networkdir,
+            "Network_{0}_T{1}_R{2}.bin".format(country, args.threads, r))
+
+    output_file = out_stem + ".avNE.severity.xls"
+
+    # Make-style up-to-date check: when the severity output is already
+    # newer than every input the run would consume, skip CovidSim and go
+    # straight to post-processing (--force overrides).  Only meaningful
+    # for firstsetup=N: first-setup runs exist to rebuild the very
+    # caches they are about to delete, so they never skip.
+    up_to_date = False
+    if (args.readonly == 'N' and args.firstsetup == 'N'
+            and not args.force and not args.dry_run):
+        inputs_mtime = max(os.stat(p).st_mtime
+                           for p in (admin_file, wpop_file_gz, pp_file, cf))
+        if (os.path.isfile(output_file)
+                and os.stat(output_file).st_mtime >= inputs_mtime):
+            print("Up-to-date, skipping: {0}".format(output_file))
+            up_to_date = True
+
+    # Stage the population density only once we know the run will
+    # actually happen, so skipped and dry runs never pay the inflate or
+    # leave a pipe behind.  On first setup CovidSim reads the text
+    # density exactly once (to build the binary cache), so the text file
+    # never needs to reach disk: prefer an anonymous in-memory file that
+    # CovidSim reads back through /proc/self/fd, fall back to streaming
+    # through a named pipe, and only stage on disk where neither is
+    # available.
+    stage_wpop = not args.dry_run and not up_to_date
+    wpop_fd = None
+    wpop_writer = None
+    wpop_future = None
+    use_wpop_fifo = False
+    if stage_wpop:
+        if args.firstsetup == 'Y':
+            try_remove(wpop_file)
+            try_remove(wpop_bin)
+            try_remove(network_bin)
+        stream_wpop = (use_fifo and args.firstsetup == 'Y'
+                       and args.readonly == 'N')
+        use_wpop_memfd = stream_wpop and hasattr(os, "memfd_create")
+        use_wpop_fifo = (stream_wpop and not use_wpop_memfd
+                         and hasattr(os, "mkfifo"))
+        if use_wpop_memfd:
+            wpop_fd = os.memfd_create("wpop_{0}".format(wpop_file_root))
+            wpop_writer = threading.Thread(
+                    target=gunzip_wpop_fd,
+                    args=(wpop_file_gz, wpop_fd),
+                    daemon=True)
+            wpop_writer.start()
+        elif use_wpop_fifo:
+            os.mkfifo(wpop_file)
+            threading.Thread(
+                    target=gunzip_wpop,
+                    args=(wpop_file_gz, wpop_file),
+                    daemon=True).start()
+        else:
+            # Skip the inflate entirely when an up-to-date copy from a
+            # previous run is already on disk; stamp fresh copies with
+            # the source mtime so later runs hit this cache.
+            src_mtime = os.stat(wpop_file_gz).st_mtime
+            if not (os.path.exists(wpop_file)
+                    and os.stat(wpop_file).st_mtime >= src_mtime
+                    and os.path.getsize(wpop_file) > 0):
+                def prefetch_wpop():
+                    gunzip_wpop(wpop_file_gz, wpop_file)
+                    os.utime(wpop_file, (src_mtime, src_mtime))
+                # Run the inflate on a worker thread so it overlaps the
+                # command construction; resolved just before launch
+                wpop_future = ThreadPoolExecutor(1).submit(prefetch_wpop)
+
+    # Run the no intervention sim.  This also does some extra setup which is one
+    # off for each R.
+
+    print("Intervention: {0} {1} {2}".format(country, root, r))
+
+    # Arguments shared by both setup modes, materialized once; only
+    # /P:, /O: and /CLPx: change when sweeping roots and controls
+    pp_arg = "/PP:" + pp_file # Preparam file
+    param_arg = "/P:" + cf # Param file
+    out_arg = "/O:" + out_stem # Output
+    r_arg = "/R:{0}".format(rs)
+
+    cmd = [
+            exe,
+            "/c:{0}".format(args.threads),
+            "/A:" + admin_file
+            ]
+    if school_file:
+        cmd.extend(["/s:" + school_file])
+
+    if args.firstsetup == 'Y':
+
+        cmd.extend([
+                pp_arg,
+                param_arg,
+                out_arg,
+                "/D:" + ("/proc/self/fd/{0}".format(wpop_fd)
+                         if wpop_fd is not None
+                         else wpop_file), # Input (this time text) pop density
+                "/M:" + wpop_bin, # Where to save binary pop density
+                "/S:" + network_bin, # Where to save binary net setup
+                r_arg,
+                "/BM:PNG"
+                ])
+        cmd.extend(seeds) # These four numbers are RNG seeds
+
+    elif args.firstsetup == 'N':
+
+        cmd.extend([
+                pp_arg,
+                param_arg,
+                out_arg,
+                "/D:" + wpop_bin, # Binary pop density file (speedup)
+                "/L:" + network_bin, # Network to load
+                r_arg,
+                "/CLP1:{0}".format(clp1), # default is 1.0 (Individual level compliance with quarantine) [0.6 - 1.0] E
+                "/CLP2:{0}".format(clp2), # default is 0.1 (Relative spatial contact rate given social distancing) [0 - 0.4] S
+                "/CLP3:{0}".format(clp3), # default is 0.9 (Proportion of detected cases isolated) [0.0 - 1.0] T
+                ])
+        cmd.extend(seeds)
+
+    if wpop_future is not None:
+        # Block until the prefetched inflate has landed on disk
+        wpop_future.result()
+
+    if args.dry_run:
+        print("Command line: " + " ".join(cmd))
+        return None
+
+    # Optionally make the severity output a pipe and reduce it on the
+    # fly while CovidSim writes it; the final write session is still
+    # saved to disk so readonly re-reads and the up-to-date check keep
+    # working.  Off by default.
+    stream_output = (args.stream_output and args.readonly == 'N'
+                     and not plot and hasattr(os, "mkfifo"))
+
+    if args.readonly == 'N' and not up_to_date:
+        print("Command line: " + " ".join(cmd))
+        if stream_output:
+            try_remove(output_file)
+            os.mkfifo(output_file)
+        if wpop_fd is not None:
+            # The memfd is a regular (in-memory) file, so it must be
+            # fully populated before CovidSim opens it
+            wpop_writer.join()
+            process = subprocess.Popen(cmd, pass_fds=(wpop_fd,))
+        else:
+            process = subprocess.Popen(cmd)
+        if stream_output:
+            stream_result = [None]
+            output_reader = threading.Thread(
+                    target=stream_severity,
+                    args=(output_file, output_file + ".tmp",
+                          stream_result, process),
+                    daemon=True)
+            output_reader.start()
+        else:
+            # While CovidSim runs, get the epilogue's work out of the
+            # way: whichever parser read_max_I will pick gets its cold
+            # import hidden behind the simulation
+            for parser_mod in ("pyarrow.csv", "numpy", "pandas"):
+                try:
+                    __import__(parser_mod)
+                    break
+                except ImportError:
+                    continue
+        process.wait()
+        if wpop_fd is not None:
+            os.close(wpop_fd)
+        if use_wpop_fifo:
+            # Remove the pipe so later runs see a regular file path again
+            try_remove(wpop_file)
+        if stream_output:
+            # Replace the pipe with the captured file before any raise,
+            # so a failed run cannot leave a FIFO behind for the next
+            # readonly invocation to block on
+            output_reader.join()
+            try_remove(output_file)
+            if os.path.exists(output_file + ".tmp"):
+                os.replace(output_file + ".tmp", output_file)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        if stream_output and stream_result[0] is not None:
+            return stream_result[0]
+
+    max_I = read_max_I(output_file)
+
+    if plot:
+        import numpy as np
+        import matplotlib.pyplot as plt
+        with open(output_file) as f:
+            i_col = f.readline().rstrip("\n").split("\t").index("I")
+        infected = np.loadtxt(output_file, delimiter="\t", skiprows=1,
+                              usecols=(i_col,))
+        plt.plot(infected)
+        plt.show()
+
+    return max_I
+
+def run_batch(args):
+    """Run the parameter sweep described by the args.batch JSON file.
+
+    The file is a dict of lists; every key is optional and defaults to
+    the single-run value:
+
+        {
+          "countries": ["United_Kingdom"],
+          "roots": ["PC7_CI_HQ_SD"],
+          "clp1": [0.6, 1.0],
+          "clp2": [0.1],
+          "clp3": [0.1],
+          "seeds": [["98798150", "729101", "17389101", "4797132"]],
+          "threads_per_run": 2
+        }
+
+    Cells are the Cartesian product of the lists, run in parallel with
+    threads_per_run CovidSim threads each.  Every cell writes to its
+    own output stem (see out_stem_name), and results are collected into
+    a single dataframe and written to results.feather in the output
+    directory.
+    """
+    with open(args.batch) as f:
+        batch_options = json.load(f)
+
+    countries = batch_options.get("countries", [args.country])
+    roots = batch_options.get("roots", [default_root])
+    clp1s = batch_options.get("clp1", [1.0])
+    clp2s = batch_options.get("clp2", [0.1])
+    clp3s = batch_options.get("clp3", [0.1])
+    seeds_list = batch_options.get("seeds", [default_seeds])
+    per_run_threads = int(batch_options.get("threads_per_run", 1))
+
+    max_workers = max(1, int(args.threads) // per_run_threads)
+
+    # Each worker gets a disjoint share of the available threads
+    run_args = argparse.Namespace(**vars(args))
+    run_args.threads = per_run_threads
+
+    if run_args.firstsetup == 'Y':
+        # First-setup runs ignore the /CLPx: controls, so cells
+        # differing only in them would rerun the same setup into the
+        # same files; sweep controls with firstsetup=N instead
+        if len(clp1s) > 1 or len(clp2s) > 1 or len(clp3s) > 1:
+            print("First-setup runs do not take /CLPx: controls; "
+                  "sweep clp1/clp2/clp3 with firstsetup=N")
+            exit(1)
+        # They also delete and regenerate the shared population and
+        # network caches, which concurrent workers would race on
+        if max_workers > 1:
+            print("First-setup sweep: running cells serially to avoid "
+                  "racing on shared population/network caches")
+            max_workers = 1
+
+    cells = list(itertools.product(
+            countries, roots, clp1s, clp2s, clp3s, seeds_list))
+
+    # Use the spawn start method so workers behave the same on Windows
+    # and Linux
+    import multiprocessing
+    ctx = multiprocessing.get_context("spawn")
+    if args.readonly == 'Y':
+        # Pure post-processing sweep: the severity files already exist,
+        # so skip run_one and fan the column reads out across workers,
+        # each returning just the scalar
+        r = 3.0
+        output_files = [
+                os.path.join(args.outputdir, out_stem_name(
+                    country, root, r, run_args.firstsetup,
+                    clp1, clp2, clp3, seeds) + ".avNE.severity.xls")
+                for country, root, clp1, clp2, clp3, seeds in cells]
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=ctx) as pool:
+            max_Is = list(pool.map(read_max_I, output_files))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=ctx) as pool:
+            # The wpop FIFO is shared per population root, so concurrent
+            # cells must stage the text file on disk instead
+            futures = [
+                    pool.submit(run_one, run_args, *cell, use_fifo=False)
+                    for cell in cells]
+            max_Is = [fut.result() for fut in futures]
+
+    import pandas as pd
+    df = pd.DataFrame(
+            cells,
+            columns=["country", "root", "clp1", "clp2", "clp3", "seeds"])
+    df["seeds"] = [" ".join(seeds) for seeds in df["seeds"]]
+    df["max_I"] = max_Is
+    try:
+        df.to_feather(os.path.join(args.outputdir, "results.feather"))
+    except ImportError:
+        # feather needs pyarrow, which is optional; keep the results
+        df.to_csv(os.path.join(args.outputdir, "results.csv"), index=False)
+    print(df)
+
+def main():
+    args = parse_args()
+    if args.batch:
+        run_batch(args)
+    else:
+        max_I = run_one(args, args.country, default_root,
+                        1.0, 0.1, 0.1, default_seeds)
+        if max_I is not None:
+            print(max_I)
+
+if __name__ == "__main__":
+    main()